@@ -1,29 +1,81 @@
 import pandas as pd
 from datetime import datetime
 from cityutils import fetch_gas_prices
+from fetchutils import FetchEngine
+from cacheutils import ResponseCache
+from storeutils import write_partition
+from qualityutils import Validator, describe
+from stateutils import state_abbreviations
+from retryutils import StateCheckpoint
 import os
 
-# We just need the state abbreviations since
-# AAA indexes their states by the abbreviation.
+output_dir = "./City Scrape/Data"
+checkpoint_file = "./City Scrape/checkpoint.json"
 
-url = "https://raw.githubusercontent.com/jasonong/List-of-US-States/refs/heads/master/states.csv"
 
-# We read the csv into a df
-states_df = pd.read_csv(url)
+def run(engine=None, pages=None):
+    """Scrapes today's metro prices and saves them. Pass a shared
+    FetchEngine to run alongside the other scrapes; otherwise one is made
+    with the on-disk response cache. `pages` are state landing pages that
+    were already fetched. Returns False if nothing changed.
 
-# And now we just map the full name to the abbreviation
-state_abbreviations = dict(zip(states_df['State'], states_df['Abbreviation']))
+    States that could not be scraped are left out of today's file and
+    recorded in the checkpoint; running again fetches just those and
+    rewrites the file."""
 
-# Here is the main function that does the scrape.
-df = fetch_gas_prices(state_abbreviations)
+    # We just need the state abbreviations since
+    # AAA indexes their states by the abbreviation.
+    # They come from the table bundled with the repo.
+    states = state_abbreviations()
 
-# Format the date for the filename
-date_str = datetime.now().strftime("%Y-%m-%d")
+    # Format the date for the filename
+    date_str = datetime.now().strftime("%Y-%m-%d")
+    output_path = f"{output_dir}/City_{date_str}.csv"
+
+    # Here is the main function that does the scrape. If today's file is
+    # already saved and no state page changed since, we can stop early.
+    checkpoint = StateCheckpoint(checkpoint_file, date_str)
+    own_engine = engine is None
+    if own_engine:
+        engine = FetchEngine(cache=ResponseCache(".http_cache"))
+    try:
+        df = fetch_gas_prices(states, engine=engine, skip_unchanged=os.path.exists(output_path), pages=pages,
+                              checkpoint=checkpoint)
+    finally:
+        if own_engine:
+            engine.close()
+            print(f"Response cache: {engine.cache.stats()}")
+
+    if df is None:
+        return False
+
+    # Check the batch before it is written; what fails goes to the quarantine
+    with engine.metrics.stage('validate', dataset='city'):
+        df, quality = Validator('city').validate(df, batch=date_str)
+    engine.metrics.increment('quarantined', quality['dropped'], dataset='city')
+    print(f"Validation: {describe(quality)}")
+    if not len(df):
+        print("Nothing passed validation; keeping what is on disk.")
+        return False
+
+    # Ensure the output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    with engine.metrics.stage('write', dataset='city'):
+        # Save the DataFrame as "/City Scrape/Data/City_{date}.csv"
+        df.to_csv(output_path, index=False)
+
+        # And the typed copy in the Parquet store
+        write_partition(df, 'city', date_str)
+
+    missing = checkpoint.missing(states)
+    if missing:
+        print(f"Saved what we have; {len(missing)} states still missing: {', '.join(missing.values())}. "
+              f"Run again to fetch just those.")
+    else:
+        checkpoint.clear()
+    return True
 
-# Ensure the output directory exists
-output_dir = "./City Scrape/Data"
-os.makedirs(output_dir, exist_ok=True)
 
-# Save the DataFrame as "/City Scrape/Data/City_{date}.csv"
-output_path = f"{output_dir}/City_{date_str}.csv"
-df.to_csv(output_path, index=False)
+if __name__ == '__main__':
+    run()
@@ -1,11 +1,35 @@
-import requests
-from bs4 import BeautifulSoup
+import os
+import sys
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
-def fetch_gas_prices(state_abbreviations):
+# The shared fetch engine lives at the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fetchutils import FetchEngine, all_unchanged
+from pageutils import fetch_state_pages, retry_failed_pages
+from parseutils import ParsePool
+from rowutils import ColumnAccumulator
+
+def fetch_gas_prices(state_abbreviations, base_url='https://gasprices.aaa.com/', engine=None, skip_unchanged=False,
+                     parser='lxml', pages=None, checkpoint=None, parse_workers=0):
     """Grabs and processes gas prices for
-    all counties. This is the parent function."""
+    all counties. This is the parent function.
+
+    Pass a shared FetchEngine as `engine` to reuse its
+    connection pool; otherwise a fresh one is made for this run.
+    With skip_unchanged and an engine that has a ResponseCache, returns
+    None without parsing when no state page changed since the last run.
+    `parser` picks the parseutils backend for the metro tables.
+    Pass `pages` ({state: StatePage} from pageutils.fetch_state_pages) to
+    reuse landing pages another scrape already fetched; their own parser
+    setting applies then. With parse_workers, the pages this call fetches
+    are parsed in that many worker processes while the rest are still
+    being fetched; the rows come out in the same order either way.
+
+    State pages that fail are fetched once more after the others are done.
+    With a StateCheckpoint, every state is saved as it is parsed and the
+    states it already holds are not fetched again, so a rerun after a
+    partial failure only fetches what is missing."""
     
     # Here we define headers.
     # This is so our scraping will be easier without being blocked. Unlikely in this case,
@@ -27,63 +51,92 @@ def fetch_gas_prices(state_abbreviations):
         "Year Ago Avg.": lambda: today - relativedelta(years=1),
     }
 
-    def extract_gas_prices(row, time_mapping, today, state, city_name):
-        """Extract and process gas price data from a row Specifically this is the row for the accordion tables found at the bottom
-        of the page."""
-        
-        cells = row.find_all('td')
-        date_text = cells[0].get_text(strip=True)
-        
-        # Get the corresponding date using time_mapping, defaulting to today
-        date = time_mapping.get(date_text, lambda: today)().strftime('%Y-%d-%m')
-        
-        # Extract prices, removing the dollar sign
-        prices = [cell.get_text(strip=True).replace('$', '') for cell in cells[1:]]
-        
-        # Return the processed data
-        return [date, state, city_name] + prices
-
-    # Helper function to process each city's data
-    def process_city_data(city, time_mapping, today, state):
-        """Process the data for a single city and extract gas prices."""
-        city_name = city.get_text(strip=True)
-        rows = city.find_next('table').select('tbody tr')
-        
-        # Use list comprehension to process each row and return the results
-        return [extract_gas_prices(row, time_mapping, today, state, city_name) for row in rows]
+    def extract_gas_prices(cells, state, city_name):
+        """Extract gas price data from a row Specifically this is the row for the accordion tables found at the bottom
+        of the page. `cells` holds the row's cell texts. The lookback label and
+        the prices are kept as text; they are converted for the whole table at once."""
+        return [cells[0], state, city_name] + cells[1:]
 
     # Function to process all states
-    def process_states(state_abbreviations, headers, time_mapping, today):
-        """Process data for all states and return accumulated data."""
-        all_data = []
-        for state, abbreviation in state_abbreviations.items():
-            params = {'state': abbreviation}
-            response = requests.get('https://gasprices.aaa.com/', params=params, headers=headers)
+    def process_states(state_abbreviations, pages):
+        """Process data for all states and return {state: rows},
+        or None when skipping unchanged pages."""
+        rows = {}
+        pages = {state: pages[state] for state in state_abbreviations if state in pages}
+
+        if skip_unchanged and all_unchanged(page.response for page in pages.values()):
+            print("No state pages changed since the last run. Skipping.")
+            return None
 
-            if response.status_code != 200:
-                print(f"Error fetching data for {state}. Status code: {response.status_code}")
+        def take(page):
+            # Pull the rows out of every city's accordion table
+            with engine.metrics.stage('parse', dataset='city'):
+                rows[page.state] = [
+                    extract_gas_prices(cells, page.state, city_name)
+                    for city_name, cells in page.metro_rows
+                ]
+            if checkpoint is not None:
+                checkpoint.put(page.abbreviation, rows[page.state])
+
+        for page in pages.values():
+            if page.ok:
+                take(page)
+
+        # The retry queue: pages that failed get one more try now
+        retry_failed_pages(pages, engine, base_url, headers)
+        for page in pages.values():
+            if page.state in rows:
                 continue
+            if page.ok:
+                take(page)
+                continue
+            print(f"Error fetching data for {page.state}. Status code: {page.status}")
+            if not page.failed and checkpoint is not None:
+                # Retrying will not help a page the server says is missing
+                checkpoint.put(page.abbreviation, [])
 
-            soup = BeautifulSoup(response.content, 'html.parser')
+        return rows
 
-            # Extract city sections
-            cities = soup.select('.accordion-prices.metros-js > h3[data-title]')
-            
-            # Use map to process each city and flatten the list of rows
-            all_data.extend([row_data for city in cities for row_data in process_city_data(city, time_mapping, today, state)])
+    # States already checkpointed today are not fetched again
+    done = checkpoint.done() if checkpoint is not None else {}
+    todo = {state: abbreviation for state, abbreviation in state_abbreviations.items() if abbreviation not in done}
+    if done:
+        print(f"Resuming: {len(done)} states already scraped today, {len(todo)} to go.")
+        skip_unchanged = False
 
-        return all_data
+    # The state pages are fetched concurrently, but come back in state order.
+    own_engine = engine is None
+    if own_engine:
+        engine = FetchEngine()
+    parse_pool = ParsePool(parse_workers) if parse_workers and pages is None else None
+    try:
+        if pages is None:
+            pages = fetch_state_pages(todo, engine, base_url, headers, parser, parse_pool)
 
-    # Process states and get all data
-    all_data = process_states(state_abbreviations, headers, time_mapping, today)
+        # Process states and get all data
+        rows = process_states(todo, pages)
+    finally:
+        if parse_pool is not None:
+            parse_pool.close()
+        if own_engine:
+            engine.close()
+    metrics = engine.metrics
 
-    # Convert list of data into DataFrame
-    all_data_df = pd.DataFrame(all_data, columns=['Date', 'State', 'City', 'Regular', 'Mid-Grade', 'Premium', 'Diesel'])
+    if rows is None:
+        return None
+    with metrics.stage('normalize', dataset='city'):
+        # Collect the rows column by column: prices to float32 and
+        # State/City interned into categoricals as they go in
+        all_data = ColumnAccumulator('city', ['Date', 'State', 'City', 'Regular', 'Mid-Grade', 'Premium', 'Diesel'])
+        for state, abbreviation in state_abbreviations.items():
+            all_data.extend(done[abbreviation] if abbreviation in done else rows.get(state, []))
 
-    # Convert 'Date' to datetime
-    all_data_df['Date'] = pd.to_datetime(all_data_df['Date'], format='%Y-%d-%m')
+        # Turn each lookback label into its date once, defaulting to today
+        dates = {label: get_date().normalize() for label, get_date in time_mapping.items()}
+        all_data_df = all_data.to_frame(dates=lambda label: dates.get(label, today.normalize()))
 
-    # Sort by 'State', 'City', and 'Date'
-    all_data_df = all_data_df.sort_values(by=['State', 'City', 'Date']).reset_index(drop=True)
+        # Sort by 'State', 'City', and 'Date'
+        all_data_df = all_data_df.sort_values(by=['State', 'City', 'Date']).reset_index(drop=True)
+    metrics.increment('rows', len(all_data_df), dataset='city')
 
     return all_data_df